@@ -2,18 +2,23 @@ import os
 import sys
 import json
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-import pandas as pd
-import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-import gspread
-from google.oauth2.service_account import Credentials
+# pandas, requests and the Google client are imported inside the functions that use
+# them, so off-schedule runs exit from the guard without paying for those imports
 
 
 ET = ZoneInfo("America/New_York")
 BASE = "https://stats.nba.com/stats"
+CACHE_DIR = os.path.join("output", ".cache")
 
 HEADERS = {
     "User-Agent": os.environ.get(
@@ -27,6 +32,9 @@ HEADERS = {
     "Connection": "keep-alive",
 }
 
+# Shared across nba_get calls (and the fetch threads) so retries reuse the TLS connection
+_SESSION = None
+
 
 def now_et():
     return datetime.now(timezone.utc).astimezone(ET)
@@ -48,17 +56,35 @@ def strict_mwf_10am_et_guard():
         sys.exit(0)
 
 
+def json_loads(data):
+    # orjson is much faster on the multi-MB game log payloads; stdlib json is the fallback
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _make_session():
+    global _SESSION
+    import requests
+
+    _SESSION = requests.Session()
+    _SESSION.headers.update(HEADERS)
+    _SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    return _SESSION
+
+
 def nba_get(endpoint, params, timeout=120, retries=6, backoff=2.0):
+    import requests
+
+    session = _SESSION or _make_session()
     url = f"{BASE}/{endpoint}"
     last_err = None
     for i in range(retries):
         try:
-            r = requests.get(url, params=params, headers=HEADERS, timeout=timeout)
+            r = session.get(url, params=params, timeout=timeout)
             # NBA sometimes returns 429/403 intermittently
             if r.status_code in (429, 403, 502, 503):
                 raise requests.HTTPError(f"HTTP {r.status_code}: {r.text[:200]}")
             r.raise_for_status()
-            return r.json()
+            return json_loads(r.content)
         except Exception as e:
             last_err = e
             sleep_s = backoff * (i + 1)
@@ -67,87 +93,146 @@ def nba_get(endpoint, params, timeout=120, retries=6, backoff=2.0):
 
 
 def resultset_to_df(payload, idx=0):
+    import pandas as pd
+
     rs = payload["resultSets"][idx]
     headers = rs["headers"]
     rows = rs["rowSet"]
     return pd.DataFrame(rows, columns=headers)
 
 
-def parse_opponent_from_matchup(matchup):
-    # "LAL vs BOS" or "LAL @ BOS" -> opponent is last token
-    return matchup.replace("vs.", "vs").split()[-1]
+def prune_cache(today):
+    # Cached logs are only valid for the ET day they were fetched on
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for name in os.listdir(CACHE_DIR):
+        if not name.startswith(f"{today}_"):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+
+def league_game_log(season, season_type, player_or_team, today):
+    import pandas as pd
+
+    params = {
+        "Counter": "0",
+        "Direction": "DESC",
+        "LeagueID": "00",
+        "PlayerOrTeam": player_or_team,
+        "Season": season,
+        "SeasonType": season_type,
+        "Sorter": "DATE",
+    }
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    cache_path = os.path.join(CACHE_DIR, f"{today}_{key}.parquet")
+    try:
+        return pd.read_parquet(cache_path)
+    except (OSError, ValueError):
+        pass
+
+    df = resultset_to_df(nba_get("leaguegamelog", params=params))
+
+    # Caching is best-effort: a failed write must not throw away data we already fetched
+    tmp_path = f"{cache_path}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(tmp_path, compression="zstd", index=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"WARNING: could not cache {player_or_team} game log: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return df
 
 
 def top_bottom_10(df, col):
-    df = df.sort_values(col, ascending=False).reset_index(drop=True)
-    top = df.head(10).copy()
+    import pandas as pd
+
+    top = df.nlargest(10, col).reset_index(drop=True)
     top.insert(0, "RANK", range(1, len(top) + 1))
     top.insert(1, "GROUP", "MOST ALLOWED")
 
-    bottom = df.tail(10).sort_values(col, ascending=True).copy()
+    bottom = df.nsmallest(10, col).reset_index(drop=True)
     bottom.insert(0, "RANK", range(1, len(bottom) + 1))
     bottom.insert(1, "GROUP", "LEAST ALLOWED")
 
     return pd.concat([top, bottom], ignore_index=True)
 
 
-def write_sheet(ws, df):
-    ws.clear()
-    ws.update([df.columns.tolist()] + df.fillna("").values.tolist())
+def sheet_values(df):
+    import numpy as np
+    import pandas as pd
+
+    # object dtype keeps numbers as numbers when "" is mixed in for missing cells
+    arr = df.to_numpy(dtype=object)
+    return [df.columns.tolist()] + np.where(pd.isna(arr), "", arr).tolist()
+
+
+def write_sheets(sh, sheets):
+    from gspread.utils import rowcol_to_a1
+
+    # Fetch the tab list once instead of a sh.worksheet(name) lookup per tab
+    ws_by_title = {ws.title: ws for ws in sh.worksheets()}
+    for name in sheets:
+        if name not in ws_by_title:
+            ws_by_title[name] = sh.add_worksheet(title=name, rows=200, cols=20)
+
+    data = []
+    for name, df in sheets.items():
+        values = sheet_values(df)
+        end = rowcol_to_a1(len(values), len(values[0]))
+        data.append({"range": f"'{name}'!A1:{end}", "values": values})
+
+    # One request to clear every tab, one to write them all
+    sh.values_batch_clear(body={"ranges": [f"'{name}'" for name in sheets]})
+    sh.values_batch_update({"valueInputOption": "RAW", "data": data})
 
 
 def main():
-    strict_mwf_10am_et_guard()
+    import numpy as np
+    import pandas as pd
+
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    # Created up front so both fetch threads share one connection pool
+    _make_session()
 
     t = now_et()
     season = os.environ.get("SEASON") or current_season_str(t)
     season_type = os.environ.get("SEASON_TYPE", "Regular Season")
     last_n = int(os.environ.get("LAST_N_GAMES_PER_TEAM", "10"))
 
-    # --- TEAM GAME LOGS (to get each team’s last N games) ---
-    team_payload = nba_get(
-        "leaguegamelog",
-        params={
-            "Counter": "0",
-            "Direction": "DESC",
-            "LeagueID": "00",
-            "PlayerOrTeam": "T",
-            "Season": season,
-            "SeasonType": season_type,
-            "Sorter": "DATE",
-        },
-    )
-    teams = resultset_to_df(team_payload)
+    today = t.strftime("%Y%m%d")
+    prune_cache(today)
 
-    # TEAM_ABBREVIATION, GAME_ID, GAME_DATE
-    teams["GAME_DATE"] = pd.to_datetime(teams["GAME_DATE"])
+    # Team and player logs are independent requests; fetch them side by side
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        team_future = pool.submit(league_game_log, season, season_type, "T", today)
+        player_future = pool.submit(league_game_log, season, season_type, "P", today)
+        teams = team_future.result()
+        players = player_future.result()
+
+    # --- TEAM GAME LOGS (to get each team’s last N games) ---
+    # Only TEAM_ABBREVIATION, GAME_ID, GAME_DATE are used; don't carry the rest through the sort
+    teams = teams[["TEAM_ABBREVIATION", "GAME_ID", "GAME_DATE"]]
+    # GAME_DATE is ISO-8601 (YYYY-MM-DD), so sorting the strings is already chronological
     teams = teams.sort_values(["TEAM_ABBREVIATION", "GAME_DATE"])
     last_games = teams.groupby("TEAM_ABBREVIATION").tail(last_n)
-    team_games = last_games.groupby("TEAM_ABBREVIATION")["GAME_ID"].apply(lambda s: set(s.astype(str))).to_dict()
-
-    # --- PLAYER GAME LOGS (all players, then filter to each DEF team's last N games) ---
-    player_payload = nba_get(
-        "leaguegamelog",
-        params={
-            "Counter": "0",
-            "Direction": "DESC",
-            "LeagueID": "00",
-            "PlayerOrTeam": "P",
-            "Season": season,
-            "SeasonType": season_type,
-            "Sorter": "DATE",
-        },
+    team_games = (
+        last_games[["TEAM_ABBREVIATION", "GAME_ID"]]
+        .rename(columns={"TEAM_ABBREVIATION": "DEF_TEAM"})
+        .astype({"GAME_ID": str})
+        .drop_duplicates()
     )
-    players = resultset_to_df(player_payload)
 
+    # --- PLAYER GAME LOGS (all players, then filter to each DEF team's last N games) ---
     # Required columns
     for c in ["GAME_ID", "MATCHUP", "PLAYER_ID", "PTS", "AST", "REB"]:
         if c not in players.columns:
             raise RuntimeError(f"Missing column {c} in player logs. Columns: {list(players.columns)}")
 
-    players["GAME_ID"] = players["GAME_ID"].astype(str)
-    players["DEF_TEAM"] = players["MATCHUP"].astype(str).apply(parse_opponent_from_matchup)
-
     # Try to find a position-like column in player logs
     pos_col = None
     for c in ["PLAYER_POSITION", "POSITION", "POS"]:
@@ -164,46 +249,52 @@ def main():
             "or a manual mapping file."
         )
 
-    # Normalize to G/F/C buckets (most consistent)
-    def norm_pos(p):
-        p = str(p).upper()
-        if "G" in p:
-            return "G"
-        if "F" in p:
-            return "F"
-        if "C" in p:
-            return "C"
-        return "UNK"
+    players = players[["GAME_ID", "MATCHUP", "PTS", "AST", "REB", pos_col]].copy()
+    players["GAME_ID"] = players["GAME_ID"].astype(str)
+    # "LAL vs. BOS" or "LAL @ BOS" -> opponent is last token
+    players["DEF_TEAM"] = players["MATCHUP"].astype(str).str.rsplit(n=1).str[-1]
+
+    # Normalize to G/F/C buckets (most consistent); first match wins, so "G-F" -> G, "F-C" -> F
+    p = players[pos_col].astype(str).str.upper()
+    players["POS"] = np.select(
+        [p.str.contains("G", regex=False), p.str.contains("F", regex=False), p.str.contains("C", regex=False)],
+        ["G", "F", "C"],
+        default="UNK",
+    )
 
-    players["POS"] = players[pos_col].apply(norm_pos)
+    # Drop unbucketed positions first so they never enter the join,
+    # then keep only each defensive team's last N games
+    players = players[players["POS"] != "UNK"]
+    players = players.merge(team_games, on=["DEF_TEAM", "GAME_ID"], how="inner")
 
-    # Filter to each defensive team's last N games
-    players = players[players.apply(lambda r: r["GAME_ID"] in team_games.get(r["DEF_TEAM"], set()), axis=1)]
-    players = players[players["POS"].isin(["G", "F", "C"])].copy()
+    # Box-score counts are small integers; NaN counts as zero, as it would in the sum
+    players[["PTS", "AST", "REB"]] = players[["PTS", "AST", "REB"]].fillna(0).astype("int32")
 
-    # Sum per (DEF_TEAM, POS, GAME_ID) then average across games
-    per_game = players.groupby(["DEF_TEAM", "POS", "GAME_ID"], as_index=False)[["PTS", "AST", "REB"]].sum()
-    allowed = per_game.groupby(["DEF_TEAM", "POS"], as_index=False)[["PTS", "AST", "REB"]].mean()
+    # Group on integer category codes rather than hashing Python strings
+    for c in ["DEF_TEAM", "POS"]:
+        players[c] = players[c].astype("category")
+
+    # Total per (DEF_TEAM, POS) over the last N games, divided by the games that position appeared in
+    sums = players.groupby(["DEF_TEAM", "POS"], sort=False, observed=True).agg(
+        PTS=("PTS", "sum"), AST=("AST", "sum"), REB=("REB", "sum"), GAMES=("GAME_ID", "nunique")
+    )
+    allowed = sums[["PTS", "AST", "REB"]].div(sums["GAMES"], axis=0)
+
+    # One DEF_TEAM x (stat, POS) table shared by every ranking; plain-string team labels for output
+    # Reindex so a position bucket with no rows yields empty rankings instead of a KeyError
+    wide = allowed.unstack("POS").reindex(columns=pd.MultiIndex.from_product([["PTS", "AST", "REB"], ["G", "F", "C"]]))
+    wide.index = wide.index.astype(str)
 
     # Build top/bottom sheets
     sheets = {}
-    def rank(pos, stat):
-        d = allowed[allowed["POS"] == pos][["DEF_TEAM", stat]].copy()
-        d = d.rename(columns={"DEF_TEAM": "TEAM", stat: f"{stat}_ALLOWED"})
-        return top_bottom_10(d, f"{stat}_ALLOWED")
-
-    sheets["G_PTS"] = rank("G", "PTS")
-    sheets["G_AST"] = rank("G", "AST")
-    sheets["G_REB"] = rank("G", "REB")
-    sheets["F_PTS"] = rank("F", "PTS")
-    sheets["F_REB"] = rank("F", "REB")
-    sheets["C_PTS"] = rank("C", "PTS")
-    sheets["C_REB"] = rank("C", "REB")
+    for pos, stat in [("G", "PTS"), ("G", "AST"), ("G", "REB"), ("F", "PTS"), ("F", "REB"), ("C", "PTS"), ("C", "REB")]:
+        d = wide[(stat, pos)].dropna().rename(f"{stat}_ALLOWED").rename_axis("TEAM").reset_index()
+        sheets[f"{pos}_{stat}"] = top_bottom_10(d, f"{stat}_ALLOWED")
 
     # Write Excel artifact
     os.makedirs("output", exist_ok=True)
     out_path = f"output/nba_allowed_by_position_last{last_n}_{t.strftime('%Y%m%d_%H%M')}.xlsx"
-    with pd.ExcelWriter(out_path, engine="openpyxl") as writer:
+    with pd.ExcelWriter(out_path, engine="xlsxwriter") as writer:
         meta = pd.DataFrame([{
             "generated_at_et": t.isoformat(),
             "season": season,
@@ -217,7 +308,7 @@ def main():
     # Update Google Sheet (optional)
     if os.environ.get("GSERVICE_JSON") and os.environ.get("GOOGLE_SHEET_ID"):
         creds = Credentials.from_service_account_info(
-            json.loads(os.environ["GSERVICE_JSON"]),
+            json_loads(os.environ["GSERVICE_JSON"]),
             scopes=[
                 "https://www.googleapis.com/auth/spreadsheets",
                 "https://www.googleapis.com/auth/drive",
@@ -225,16 +316,11 @@ def main():
         )
         gc = gspread.authorize(creds)
         sh = gc.open_by_key(os.environ["GOOGLE_SHEET_ID"])
-
-        for name, df in sheets.items():
-            try:
-                ws = sh.worksheet(name)
-            except gspread.exceptions.WorksheetNotFound:
-                ws = sh.add_worksheet(title=name, rows=200, cols=20)
-            write_sheet(ws, df)
+        write_sheets(sh, sheets)
 
     print("SUCCESS")
 
 
 if __name__ == "__main__":
+    strict_mwf_10am_et_guard()
     main()